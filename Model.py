@@ -1,6 +1,7 @@
 import torch
 from torch import nn
 import torch.nn.functional as F
+import numpy as np
 from Beam import Beam
 
 torch.manual_seed(1)
@@ -45,17 +46,31 @@ class BahdanauAttention(nn.Module):
         self.W_U = nn.Linear((enc_dim + dec_dim), dec_dim)
         self.V = nn.Linear(dec_dim, 1)
 
-    def forward(self, enc_outs, s_prev, mask=None):
+    def project(self, enc_outs):
+        """
+        the encoder half of W_U, which does not depend on the decoder step, so it can be
+        computed once per batch and passed to forward as enc_proj
+        :return: shape [batch, seq_len, dec_dim]
+        """
+        return F.linear(enc_outs, self.W_U.weight[:, :enc_outs.shape[-1]])
+
+    def forward(self, enc_outs, s_prev, mask=None, enc_proj=None):
         """
         calculate the context vector c_t, both the input and output are batch first
         :param enc_outs: the encoder states, in shape [batch, seq_len, dim]
         :param s_prev: the previous states of decoder, h_{t-1}, in shape [1, batch, dim]
         :param mask: mask for pad value
+        :param enc_proj: project(enc_outs), computed here if not given
         :return: c_t: context vector
         """
-        s_expanded = s_prev.transpose(0,1).expand(-1, enc_outs.shape[1], -1)
-        cat = torch.cat([enc_outs, s_expanded], dim=-1)
-        alpha_t = self.V(torch.tanh(self.W_U(cat))).transpose(1, 2) # [batch, 1, seq_len]
+        # W_U([h; s]) = W_U[:, :enc_dim] h + W_U[:, enc_dim:] s + b, so the two halves are
+        # projected separately and broadcast, instead of materializing the expanded
+        # [batch, seq_len, enc_dim + dec_dim] concat tensor at every decoder step
+        enc_dim = enc_outs.shape[-1]
+        if enc_proj is None:
+            enc_proj = self.project(enc_outs)  # [batch, seq_len, dec_dim]
+        dec_proj = F.linear(s_prev.transpose(0,1), self.W_U.weight[:, enc_dim:], self.W_U.bias)  # [batch, 1, dec_dim]
+        alpha_t = self.V(torch.tanh(enc_proj + dec_proj)).transpose(1, 2) # [batch, 1, seq_len]
         if mask is not None:
             alpha_t = alpha_t.masked_fill(mask, -1e9)
         e_t = F.softmax(alpha_t, dim=-1)
@@ -63,10 +78,71 @@ class BahdanauAttention(nn.Module):
         return c_t
 
 
+class LocalAttention(nn.Module):
+    def __init__(self, enc_dim, dec_dim, window=10):
+        """
+        local-p attention of Luong et al. (2015), only the 2*window+1 encoder states around
+        a predicted source position are scored, so a decoder step costs O(window) instead of O(seq_len)
+        """
+        super(LocalAttention, self).__init__()
+        self.window = window
+        self.W_p = nn.Linear(dec_dim, dec_dim)
+        self.v_p = nn.Linear(dec_dim, 1, bias=False)
+        self.W = nn.Linear(enc_dim + dec_dim, dec_dim)
+        self.V = nn.Linear(dec_dim, 1)
+        self.softmax = nn.Softmax(dim=-1)
+
+    def project(self, enc_outs):
+        """
+        the encoder half of W, which does not depend on the decoder step, so it can be
+        computed once per batch and passed to forward as enc_proj
+        :return: shape [batch, seqlen, dec_dim]
+        """
+        return F.linear(enc_outs, self.W.weight[:, :enc_outs.shape[-1]])
+
+    def forward(self, enc_outs, ht, mask=None, enc_proj=None):
+        """
+        :param enc_outs: shape = [batch, seqlen, enc_dim]
+        :param ht: shape = [1, batch, dec_dim]
+        :param mask: mask for pad value, in shape [batch, 1, seqlen]
+        :param enc_proj: project(enc_outs), computed here if not given
+        """
+        batch, seq_len, enc_dim = enc_outs.shape
+        if enc_proj is None:
+            enc_proj = self.project(enc_outs)
+        ht = ht.transpose(0,1)  # batch, 1, dec_dim
+        if mask is None:
+            src_len = enc_outs.new_full((batch, 1), seq_len)
+        else:
+            src_len = mask.eq(0).sum(-1).float()  # batch, 1
+        # predicted aligned position, p_t in [0, src_len - 1]
+        p_t = (src_len - 1) * torch.sigmoid(self.v_p(torch.tanh(self.W_p(ht)))).squeeze(-1)
+        offsets = torch.arange(-self.window, self.window + 1, device=enc_outs.device)
+        pos = p_t.detach().round().long() + offsets  # batch, 2*window+1
+        valid = (pos >= 0) & (pos.float() < src_len)
+        # gaussian centered at p_t (sigma = window / 2), through which p_t gets its gradient
+        gauss = torch.exp(-(pos.float() - p_t) ** 2 / (2 * (self.window / 2) ** 2))
+
+        pos = pos.clamp(0, seq_len - 1).unsqueeze(-1)
+        enc_window = enc_outs.gather(1, pos.expand(-1, -1, enc_dim))  # batch, 2*window+1, enc_dim
+        # as in BahdanauAttention, W([h; s]) is split into the precomputed encoder half,
+        # gathered over the window, plus the decoder half broadcast over it
+        proj_window = enc_proj.gather(1, pos.expand(-1, -1, enc_proj.shape[-1]))  # batch, 2*window+1, dec_dim
+        dec_proj = F.linear(ht, self.W.weight[:, enc_dim:], self.W.bias)  # batch, 1, dec_dim
+        scores = self.V(torch.tanh(proj_window + dec_proj)).transpose(1, 2)  # batch, 1, 2*window+1
+        scores = scores.masked_fill(valid.eq(0).unsqueeze(1), -1e9)
+        weights = self.softmax(scores) * gauss.unsqueeze(1)
+        c_t = torch.bmm(weights, enc_window)  # batch, 1, enc_dim
+        return c_t
+
+
 class Model(nn.Module):
-    def __init__(self, vocab, emb_dim=32, hid_dim=128, embeddings=None, attn='bahdanau'):
+    def __init__(self, vocab, emb_dim=32, hid_dim=128, embeddings=None, attn='bahdanau', window=10):
+        """
+        :param attn: 'bahdanau', 'luong' or 'local' (local-p attention over 2*window+1 source positions)
+        """
         super(Model, self).__init__()
-        assert attn in ['luong', 'bahdanau']
+        assert attn in ['luong', 'bahdanau', 'local']
         self.hid_dim = hid_dim
         self.emb_dim = emb_dim
         self.vocab = vocab
@@ -91,6 +167,10 @@ class Model(nn.Module):
             self.attn_layer = LuongAttention(hid_dim, hid_dim, align='concat')
             self.decoder = nn.GRU(emb_dim, hid_dim, batch_first=True)
             self.decoder2vocab = nn.Linear(hid_dim * 2, self.n_vocab)
+        elif attn == 'local':
+            self.attn_layer = LocalAttention(hid_dim, hid_dim, window=window)
+            self.decoder = nn.GRU(emb_dim, hid_dim, batch_first=True)
+            self.decoder2vocab = nn.Linear(hid_dim, self.n_vocab)
         else:
             self.attn_layer = BahdanauAttention(hid_dim, hid_dim)
             self.decoder = nn.GRU(emb_dim + hid_dim, hid_dim, batch_first=True)
@@ -125,25 +205,114 @@ class Model(nn.Module):
         outputs = outputs * sGate
         return outputs, hidden
 
+    def project_enc(self, enc_outs):
+        """
+        step independent part of the attention, to be passed to decode as enc_proj,
+        None if the attention type has none
+        """
+        if self.attn in ['bahdanau', 'local']:
+            return self.attn_layer.project(enc_outs)
+        return None
+
     def maxout(self, w, c_t, hidden):
         r_t = self.W(w) + self.U(c_t) + self.V(hidden.transpose(0,1))
         m_t = F.max_pool1d(r_t, kernel_size=2, stride=2)
         return self.dropout(m_t)
 
-    def decode(self, word, enc_outs, hidden, mask=None):
+    def decode(self, word, enc_outs, hidden, mask=None, enc_proj=None):
         embeds = self.embedding_look_up(word).view(-1, 1, self.emb_dim)
         embeds = self.dropout(embeds)
         if self.attn == 'luong':
             outputs, hidden = self.decoder(embeds, hidden)
             c_t = self.attn_layer(enc_outs, hidden, mask)
+        elif self.attn == 'local':
+            outputs, hidden = self.decoder(embeds, hidden)
+            c_t = self.attn_layer(enc_outs, hidden, mask, enc_proj)
         else:
-            c_t = self.attn_layer(enc_outs, hidden, mask)
+            c_t = self.attn_layer(enc_outs, hidden, mask, enc_proj)
             outputs, hidden = self.decoder(torch.cat([c_t, embeds], dim=-1), hidden)
         outputs = self.maxout(embeds, c_t, hidden).squeeze()  # comment this line to remove maxout
         logit = self.decoder2vocab(outputs).squeeze()
         return logit, hidden
 
 
+def greedy(model, batch_x, max_trg_len=15):
+    enc_outs, hidden = model.encode(batch_x)
+    hidden = model.init_decoder_hidden(hidden)
+    mask = batch_x.eq(model.vocab['<pad>']).unsqueeze(1)
+    enc_proj = model.project_enc(enc_outs)
+    
+    words = []
+    word = torch.ones(hidden.shape[1], dtype=torch.long, device=batch_x.device) * model.vocab["<s>"]
+    for _ in range(max_trg_len):
+        logit, hidden = model.decode(word, enc_outs, hidden, mask, enc_proj)
+        # decode squeezes the batch dimension away when the batch holds one sample
+        word = torch.argmax(logit.view(hidden.shape[1], -1), dim=-1)
+        words.append(word.cpu().numpy())
+    return np.array(words).T  # batch, max_trg_len
+
+
+def beam_search(model, batch_x, max_trg_len=15, k=12):
+    enc_outs, hidden = model.encode(batch_x)
+    hidden = model.init_decoder_hidden(hidden)
+    mask = batch_x.eq(model.vocab['<pad>']).unsqueeze(1)
+    enc_proj = model.project_enc(enc_outs)
+    b_size = batch_x.shape[0]
+
+    beams = [Beam(k, model.vocab, hidden[:,i,:], device=batch_x.device) for i in range(b_size)]
+
+    # k copies of every sample, made once and only re-indexed when some beams finish
+    active = list(range(b_size))
+    _enc_outs_ = enc_outs.repeat_interleave(k, dim=0)
+    _mask_ = mask.repeat_interleave(k, dim=0)
+    _enc_proj_ = enc_proj.repeat_interleave(k, dim=0) if enc_proj is not None else None
+    
+    for _ in range(max_trg_len):
+        not_finish = [j for j in range(b_size) if not beams[j].done]
+        if len(not_finish) == 0:
+            break
+        if len(not_finish) < len(active):
+            pos = torch.tensor([active.index(j) for j in not_finish], device=batch_x.device)
+            rows = (pos.unsqueeze(1) * k + torch.arange(k, device=batch_x.device)).view(-1)
+            _enc_outs_ = _enc_outs_.index_select(0, rows)
+            _mask_ = _mask_.index_select(0, rows)
+            if _enc_proj_ is not None:
+                _enc_proj_ = _enc_proj_.index_select(0, rows)
+            active = not_finish
+        _word_ = torch.cat([beams[j].get_current_word() for j in not_finish], dim=0)
+        _hidden_ = torch.cat([beams[j].get_hidden_state() for j in not_finish], dim=1)
+
+        logits, hidden = model.decode(_word_, _enc_outs_, _hidden_, _mask_, _enc_proj_)
+        log_probs = torch.log(F.softmax(logits, -1))
+        idx = 0
+        for j in not_finish:
+            beams[j].advance_(log_probs[idx: idx+k], hidden[:, idx: idx+k, :])
+            idx += k
+
+        # for j in range(b_size):
+        #     word = beams[j].get_current_word()
+        #     enc_outs_j = enc_outs[j].unsqueeze(0).expand(k, -1, -1)
+        #     hidden = beams[j].get_hidden_state()
+        #     mask_j = mask[j].unsqueeze(0).expand(k, -1, -1)
+
+        #     logit, hidden = model.decode(word, enc_outs_j, hidden, mask_j)
+        #     # logit: [k x V], hidden: [k x hid_dim]
+        #     log_probs = torch.log(F.softmax(logit, -1))
+        #     beams[j].advance_(log_probs, hidden)
+
+    allHyp, allScores = [], []
+    n_best = 1
+    for b in range(batch_x.shape[0]):
+        scores, ks = beams[b].sort_best()
+        allScores += [scores[:n_best]]
+        hyps = [beams[b].get_hyp(k) for k in ks[:n_best]]
+        allHyp.append(hyps)
+
+    # shape of allHyp: [batch, 1, list]
+    allHyp = [[int(w.cpu().numpy()) for w in hyp[0]] for hyp in allHyp]
+    return allHyp
+
+
 if __name__ == '__main__':
     import json
 
@@ -0,0 +1,157 @@
+import os
+import gc
+import json
+import time
+import resource
+import torch
+import torch.multiprocessing as mp
+import argparse
+import utils
+from utils import BatchManager, load_data
+from Model import Model, greedy, beam_search
+
+parser = argparse.ArgumentParser(description='Compare decoding speed, memory and ROUGE of several models')
+
+parser.add_argument('--ckpts', type=str, nargs='*', default=[], help='trained model files to compare')
+parser.add_argument('--attns', type=str, nargs='*', default=[],
+					help='attention types to time with randomly initialized models, e.g. bahdanau local')
+parser.add_argument('--window', type=int, default=10, help='half width of local attention for --attns')
+parser.add_argument('--n_test', type=int, default=1936, help='Number of test data (up to 1951 in gigaword)')
+parser.add_argument('--input_file', type=str, default="sumdata/train/test.article.txt", help='input file')
+parser.add_argument('--ref_file', type=str, default="", help='reference summaries, one per line, skip ROUGE if empty')
+parser.add_argument('--vocab_file', type=str, default="sumdata/vocab.json")
+parser.add_argument('--batch_size', type=int, default=64, help='Mini batch size [default: 64]')
+parser.add_argument('--search', type=str, default='greedy', help='greedy/beam')
+parser.add_argument('--beam_width', type=int, default=12, help='beam search width')
+parser.add_argument('--max_src_len', type=int, default=0, help='Truncate source articles to this many words')
+parser.add_argument('--max_trg_len', type=int, default=15, help='Number of decoding steps')
+parser.add_argument('--device', type=str, default='cuda', help='cuda/cpu')
+parser.add_argument('--threads', type=int, default=0, help='Number of CPU threads, 0 for the torch default')
+args = parser.parse_args()
+
+device = torch.device(args.device)
+if args.threads > 0:
+	torch.set_num_threads(args.threads)
+
+
+def build_model(vocab, ckpt_file=None, attn='bahdanau'):
+	if ckpt_file is None:
+		return Model(vocab, emb_dim=256, hid_dim=512, attn=attn, window=args.window), 'random/%s' % attn
+	if not os.path.exists(ckpt_file):
+		raise FileNotFoundError("model file %s not found" % ckpt_file)
+	saved_state = torch.load(ckpt_file, map_location='cpu')
+	attn = saved_state.get('attn', 'bahdanau')
+	hid_dim = saved_state.get('hid_dim', 512)
+	model = Model(vocab, emb_dim=saved_state.get('emb_dim', 256), hid_dim=hid_dim,
+				  attn=attn, window=saved_state.get('window') or 10)
+	model.load_state_dict(saved_state['state_dict'])
+	return model, '%s/%s/%d' % (ckpt_file, attn, hid_dim)
+
+
+def current_rss():
+	"""
+	resident memory of this process in MB, linux only
+	"""
+	with open('/proc/self/statm') as fin:
+		return int(fin.read().split()[1]) * resource.getpagesize() / 2**20
+
+
+def peak_rss():
+	# in KB on linux
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def to_words(summary, i2w):
+	words = []
+	for tok in summary:
+		word = i2w[int(tok)]
+		if word == '</s>':
+			break
+		if word != '<pad>':
+			words.append(word)
+	return words
+
+
+def evaluate(model, test_x, refs, i2w, rss_base=0., peak_base=0.):
+	"""
+	:param rss_base, peak_base: current and peak resident memory (MB) before the model was built,
+		the peak memory on CPU is reported relative to rss_base, so it leaves out torch and the data
+	"""
+	test_x.bid = 0
+	summaries = []
+	elapsed = 0
+	# the process peak only tells about the model if the model raised it, so sample the current
+	# resident memory after every batch as well
+	rss_max = current_rss()
+	if device.type == 'cuda':
+		torch.cuda.reset_peak_memory_stats()
+	with torch.no_grad():
+		for _ in range(test_x.steps):
+			batch_x = test_x.next_batch().to(device)
+			start = time.time()
+			if args.search == "greedy":
+				summary = greedy(model, batch_x, args.max_trg_len)
+			elif args.search == "beam":
+				summary = beam_search(model, batch_x, args.max_trg_len, k=args.beam_width)
+			else:
+				raise NameError("Unknown search method")
+			if device.type == 'cuda':
+				torch.cuda.synchronize()
+			elapsed += time.time() - start
+			summaries.extend(summary)
+			rss_max = max(rss_max, current_rss())
+
+	result = {'ms/batch': 1000 * elapsed / test_x.steps,
+			  'params(MB)': sum(p.numel() * p.element_size() for p in model.parameters()) / 2**20}
+	if device.type == 'cuda':
+		result['peak(MB)'] = torch.cuda.max_memory_allocated() / 2**20
+	else:
+		peak = peak_rss()
+		result['peak(MB)'] = (peak if peak > peak_base else rss_max) - rss_base
+	if refs:
+		hyps = [to_words(s, i2w) for s in summaries]
+		result['R-1'] = 100 * sum(utils.rouge_n(h, r, 1) for h, r in zip(hyps, refs)) / len(hyps)
+		result['R-2'] = 100 * sum(utils.rouge_n(h, r, 2) for h, r in zip(hyps, refs)) / len(hyps)
+		result['R-L'] = 100 * sum(utils.rouge_l(h, r) for h, r in zip(hyps, refs)) / len(hyps)
+	return result
+
+
+def run_candidate(ckpt_file, attn):
+	vocab = json.load(open(args.vocab_file))
+	i2w = {key: value for value, key in vocab.items()}
+	i2w[vocab['<unk>']] = 'UNK'
+
+	test_x = BatchManager(load_data(args.input_file, vocab, args.n_test, max_len=args.max_src_len or None),
+						  args.batch_size)
+	refs = None
+	if args.ref_file and ckpt_file:
+		refs = [line.strip().split() for _, line in zip(range(args.n_test), open(args.ref_file, encoding='utf8'))]
+
+	gc.collect()
+	rss_base, peak_base = current_rss(), peak_rss()
+	model, name = build_model(vocab, ckpt_file, attn)
+	model.to(device)
+	model.eval()
+	return name, evaluate(model, test_x, refs, i2w, rss_base, peak_base)
+
+
+def main():
+	print(args)
+	candidates = [(None, attn) for attn in args.attns] + [(ckpt, None) for ckpt in args.ckpts]
+	results = []
+	# each model runs in a fresh process, as the peak memory of a process never goes down
+	ctx = mp.get_context('spawn')
+	for ckpt_file, attn in candidates:
+		with ctx.Pool(1) as pool:
+			name, result = pool.apply(run_candidate, (ckpt_file, attn))
+		print(name, result)
+		results.append((name, result))
+
+	columns = ['ms/batch', 'params(MB)', 'peak(MB)', 'R-1', 'R-2', 'R-L']
+	print('%-40s' % 'model' + ''.join('%12s' % c for c in columns))
+	for name, result in results:
+		print('%-40s' % name + ''.join('%12.2f' % result[c] if c in result else '%12s' % '-' for c in columns))
+
+
+if __name__ == '__main__':
+	main()
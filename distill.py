@@ -0,0 +1,163 @@
+import os
+import json
+import torch
+import argparse
+import numpy as np
+import utils
+from utils import BatchManager, load_data
+from Model import Model, greedy, beam_search
+
+parser = argparse.ArgumentParser(description='Cache the outputs of a teacher model for knowledge distillation')
+
+parser.add_argument('--teacher_ckpt', type=str, required=True, help='trained teacher model file')
+parser.add_argument('--n_train', type=int, default=300000, help='Number of training data (up to 300000 in gigaword)')
+parser.add_argument('--data_dir', type=str, default='sumdata/')
+parser.add_argument('--batch_size', type=int, default=64, help='Mini batch size [default: 64]')
+parser.add_argument('--max_src_len', type=int, default=0,
+					help='Truncate source articles to this many words, should match training [default: 0]')
+parser.add_argument('--seq_file', type=str, default='',
+					help='Where to write the teacher summaries for sequence-level distillation, skip if empty')
+parser.add_argument('--search', type=str, default='greedy', help='greedy/beam, used for --seq_file')
+parser.add_argument('--beam_width', type=int, default=12, help='beam search width')
+parser.add_argument('--max_trg_len', type=int, default=15, help='Maximum length of teacher summaries')
+parser.add_argument('--soft_file', type=str, default='',
+					help='Where to write the teacher top-k logits for word-level distillation, skip if empty')
+parser.add_argument('--topk', type=int, default=8, help='Number of teacher logits kept per step [default: 8]')
+parser.add_argument('--device', type=str, default='cuda', help='cuda/cpu')
+args = parser.parse_args()
+print(args)
+
+device = torch.device(args.device)
+
+
+def load_teacher(vocab, ckpt_file):
+	if not os.path.exists(ckpt_file):
+		raise FileNotFoundError("model file %s not found" % ckpt_file)
+	saved_state = torch.load(ckpt_file, map_location='cpu')
+	model = Model(vocab, emb_dim=saved_state.get('emb_dim', 256), hid_dim=saved_state.get('hid_dim', 512),
+				  attn=saved_state.get('attn', 'bahdanau'), window=saved_state.get('window') or 10)
+	model.load_state_dict(saved_state['state_dict'])
+	print('Load teacher parameters from %s' % ckpt_file)
+	return model.to(device).eval()
+
+
+def write_summaries(model, train_x, vocab, out_file):
+	"""
+	decode the training articles with the teacher, one summary per line, so that the file
+	can be passed to train.py --train_y in place of the reference titles
+	"""
+	i2w = {key: value for value, key in vocab.items()}
+	# written aside and moved into place when complete, so an interrupted run leaves no partial cache
+	tmp_file = out_file + '.tmp'
+	fout = open(tmp_file, "w", encoding="utf8")
+	with torch.no_grad():
+		for i in range(train_x.steps):
+			print(i, end=' ', flush=True)
+			batch_x = train_x.next_batch().to(device)
+			if args.search == "greedy":
+				summaries = greedy(model, batch_x, args.max_trg_len)
+			elif args.search == "beam":
+				summaries = beam_search(model, batch_x, args.max_trg_len, k=args.beam_width)
+			else:
+				raise NameError("Unknown search method")
+			for summary in summaries:
+				words = []
+				for tok in summary:
+					if int(tok) == vocab['</s>']:
+						break
+					if int(tok) != vocab['<pad>']:
+						words.append(i2w[int(tok)])
+				fout.write(" ".join(words) + "\n")
+	fout.close()
+	os.replace(tmp_file, out_file)
+	print("Done!")
+
+
+def compute_soft_targets(model, train_x, train_y, k):
+	"""
+	teacher-forced decoding of the training targets, keep the top-k logits of every step
+	:return: word ids and logits of all samples concatenated into [n_steps_total, k] tensors,
+		sample i in rows offsets[i]: offsets[i+1], with n_steps = len(target) - 1 per sample
+	"""
+	all_idx, all_logits, all_lengths = [], [], []
+	with torch.no_grad():
+		for i in range(train_x.steps):
+			print(i, end=' ', flush=True)
+			batch_x = train_x.next_batch().to(device)
+			batch_y = train_y.next_batch().to(device)
+			mask = batch_x.eq(model.vocab['<pad>']).unsqueeze(1)
+
+			outputs, hidden = model.encode(batch_x)
+			hidden = model.init_decoder_hidden(hidden)
+			enc_proj = model.project_enc(outputs)
+			step_logits, step_idx = [], []
+			for t in range(batch_y.shape[1] - 1):
+				logit, hidden = model.decode(batch_y[:, t], outputs, hidden, mask, enc_proj)
+				logit, idx = logit.view(batch_y.shape[0], -1).topk(k, dim=-1)
+				step_logits.append(logit)
+				step_idx.append(idx)
+			batch_logits = torch.stack(step_logits, dim=1).half().cpu()  # batch, seq_len - 1, k
+			batch_idx = torch.stack(step_idx, dim=1).int().cpu()
+			lengths = (batch_y.ne(model.vocab['<pad>']).sum(-1) - 1).tolist()
+			for j in range(len(lengths)):
+				all_idx.append(batch_idx[j, :lengths[j]])
+				all_logits.append(batch_logits[j, :lengths[j]])
+				all_lengths.append(lengths[j])
+	print("Done!")
+	offsets = torch.from_numpy(np.cumsum([0] + all_lengths))
+	return torch.cat(all_idx), torch.cat(all_logits), offsets
+
+
+def main():
+	data_dir = args.data_dir
+	TRAIN_X = os.path.join(data_dir, 'train/train.article.txt')
+	TRAIN_Y = os.path.join(data_dir, 'train/train.title.txt')
+
+	vocab = json.load(open(os.path.join(data_dir, "vocab.json")))
+	model = load_teacher(vocab, args.teacher_ckpt)
+	# train.py does not shuffle, so the cached outputs stay aligned with the training data by index
+	train_x = BatchManager(load_data(TRAIN_X, vocab, args.n_train, max_len=args.max_src_len or None),
+						   args.batch_size)
+
+	teacher_ckpt = os.path.abspath(args.teacher_ckpt)
+	if args.seq_file:
+		# settings the teacher summaries depend on, kept next to them to detect a stale cache
+		seq_meta = {'teacher_ckpt': teacher_ckpt, 'search': args.search, 'beam_width': args.beam_width,
+					'max_trg_len': args.max_trg_len, 'max_src_len': args.max_src_len}
+		meta_file = args.seq_file + '.meta.json'
+		if os.path.exists(args.seq_file):
+			n_lines = utils.count_lines(args.seq_file)
+			if n_lines != len(train_x.datas):
+				raise ValueError('%s holds %d summaries but there are %d training articles, delete it to recompute'
+								 % (args.seq_file, n_lines, len(train_x.datas)))
+			if not os.path.exists(meta_file) or json.load(open(meta_file)) != seq_meta:
+				raise ValueError('%s was not computed with this teacher and these settings, delete it to recompute'
+								 % args.seq_file)
+			print('Teacher summaries already cached in %s' % args.seq_file)
+		else:
+			json.dump(seq_meta, open(meta_file, 'w'))
+			write_summaries(model, train_x, vocab, args.seq_file)
+		# word-level targets are then computed on the teacher summaries, as the student is trained on them
+		TRAIN_Y = args.seq_file
+
+	if args.soft_file:
+		if os.path.exists(args.soft_file):
+			soft_targets = torch.load(args.soft_file)
+			if (soft_targets['teacher_ckpt'] != teacher_ckpt or soft_targets['targets'] != os.path.abspath(TRAIN_Y)
+					or soft_targets['targets_stamp'] != utils.file_stamp(TRAIN_Y)):
+				raise ValueError('%s was computed with another teacher or targets file, delete it to recompute'
+								 % args.soft_file)
+			print('Teacher soft targets already cached in %s' % args.soft_file)
+		else:
+			train_x.bid = 0
+			train_y = BatchManager(load_data(TRAIN_Y, vocab, args.n_train), args.batch_size)
+			idx, logits, offsets = compute_soft_targets(model, train_x, train_y, args.topk)
+			# only tensors and plain values, so that torch.load works with weights_only=True
+			torch.save({'topk': args.topk, 'teacher_ckpt': teacher_ckpt, 'targets': os.path.abspath(TRAIN_Y),
+						'targets_stamp': utils.file_stamp(TRAIN_Y),
+						'idx': idx, 'logits': logits, 'offsets': offsets}, args.soft_file + '.tmp')
+			os.replace(args.soft_file + '.tmp', args.soft_file)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import random
+import itertools
+import torch
+import argparse
+import numpy as np
+import torch.multiprocessing as mp
+import utils
+from Model import Model
+from utils import BatchManager, PackedData, load_data
+from train import run_batch, train_step
+
+parser = argparse.ArgumentParser(description='Hyperparameter sweep running short training trials in parallel')
+
+parser.add_argument('--spec', type=str, required=True,
+					help='json file, e.g. {"search": "grid", "params": {"lr": [0.001, 0.0005], "attn": ["bahdanau", "local"]}}')
+parser.add_argument('--n_trials', type=int, default=16, help='Number of trials of a random search [default: 16]')
+parser.add_argument('--workers', type=int, default=8, help='Number of trials running at the same time [default: 8]')
+parser.add_argument('--threads', type=int, default=1, help='Number of CPU threads of each trial [default: 1]')
+parser.add_argument('--n_train', type=int, default=300000, help='Number of training data [default: 300000]')
+parser.add_argument('--n_valid', type=int, default=2000, help='Number of validation data [default: 2000]')
+parser.add_argument('--data_dir', type=str, default='sumdata/')
+parser.add_argument('--max_src_len', type=int, default=0, help='Truncate source articles to this many words')
+parser.add_argument('--max_steps', type=int, default=2000, help='Training steps of each trial [default: 2000]')
+parser.add_argument('--eval_every', type=int, default=200, help='Validate every this many steps [default: 200]')
+parser.add_argument('--grace_steps', type=int, default=400,
+					help='Do not stop trials before this many steps [default: 400]')
+parser.add_argument('--min_peers', type=int, default=3,
+					help='Number of other trials that must have reached a step before stopping at it [default: 3]')
+parser.add_argument('--seed', type=int, default=1)
+parser.add_argument('--out', type=str, default='log/sweep.tsv', help='Where to write the result table')
+
+# used when a trial does not set them, every key has the same meaning as the train.py flag
+# of the same name, so the best config can be passed back to train.py as is
+DEFAULTS = {'lr': 0.001, 'batch_size': 32, 'attn': 'bahdanau', 'window': 10,
+			'lr_step': 1000, 'lr_gamma': 0.5, 'lr_max_decays': 6, 'emb_dim': 256, 'hid_dim': 512}
+
+
+def sample_configs(spec, n_trials, seed=1):
+	"""
+	:param spec: {"search": "grid" or "random", "params": {name: values}}, values is a list of choices,
+		or {"min": a, "max": b, "log": true/false} for a continuous range (random search only)
+	:return: list of config dicts, defaults filled in
+	"""
+	params = spec['params']
+	if spec.get('search', 'grid') == 'grid':
+		names = list(params)
+		configs = [dict(zip(names, values)) for values in itertools.product(*[params[n] for n in names])]
+	elif spec['search'] == 'random':
+		rng = random.Random(seed)
+		configs = []
+		for _ in range(n_trials):
+			config = {}
+			for name, values in params.items():
+				if isinstance(values, dict):
+					if values.get('log', False):
+						config[name] = float(np.exp(rng.uniform(np.log(values['min']), np.log(values['max']))))
+					else:
+						config[name] = rng.uniform(values['min'], values['max'])
+				else:
+					config[name] = rng.choice(values)
+			configs.append(config)
+	else:
+		raise NameError("Unknown search method")
+	return [dict(DEFAULTS, **config) for config in configs]
+
+
+def init_worker(datas, vocab, history, threads):
+	global _datas, _vocab, _history
+	_datas, _vocab, _history = datas, vocab, history
+	torch.set_num_threads(threads)
+
+
+def validate(valid_x, valid_y, model):
+	valid_x.bid = 0
+	valid_y.bid = 0
+	model.eval()
+	with torch.no_grad():
+		loss = sum(float(run_batch(valid_x, valid_y, model)) for _ in range(valid_x.steps)) / valid_x.steps
+	model.train()
+	return loss
+
+
+def should_stop(trial_id, n_evals, loss, min_peers):
+	"""
+	median stopping rule, stop if the validation loss is worse than the median of the
+	other trials at the same number of steps
+	"""
+	peers = [losses[n_evals - 1] for tid, losses in _history.items() if tid != trial_id and len(losses) >= n_evals]
+	return len(peers) >= min_peers and loss > np.median(peers)
+
+
+def run_trial(trial_id, config, max_steps, eval_every, grace_steps, min_peers, seed=1):
+	"""
+	train one config, a failing trial is reported with status 'failed' instead of stopping the sweep
+	"""
+	start = time.time()
+	try:
+		return train_trial(trial_id, config, max_steps, eval_every, grace_steps, min_peers, seed)
+	except Exception as e:
+		losses = _history.get(trial_id, [])
+		return failed_result(trial_id, config, e, losses, len(losses) * eval_every, (time.time() - start) / 60)
+
+
+def failed_result(trial_id, config, error, losses=(), steps=0, minutes=0.):
+	"""
+	:param steps: number of steps validated before the error
+	"""
+	# on one line, to keep the table readable
+	error = ' '.join(('%s: %s' % (type(error).__name__, error)).split())
+	return {'trial': trial_id, 'status': 'failed', 'steps': steps,
+			'best_valid_loss': min(losses) if losses else float('nan'),
+			'last_valid_loss': losses[-1] if losses else float('nan'),
+			'minutes': minutes, 'config': config, 'error': error}
+
+
+def train_trial(trial_id, config, max_steps, eval_every, grace_steps, min_peers, seed=1):
+	start = time.time()
+	torch.manual_seed(seed + trial_id)
+	batch_size = config['batch_size']
+	train_x = BatchManager(_datas['train_x'], batch_size)
+	train_y = BatchManager(_datas['train_y'], batch_size)
+	valid_x = BatchManager(_datas['valid_x'], batch_size)
+	valid_y = BatchManager(_datas['valid_y'], batch_size)
+
+	model = Model(_vocab, emb_dim=config['emb_dim'], hid_dim=config['hid_dim'],
+				  attn=config['attn'], window=config['window'])
+	optimizer = torch.optim.Adam(model.parameters(), lr=config['lr'])
+	scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=config['lr_step'], gamma=config['lr_gamma'])
+	max_decay_steps = config['lr_step'] * config['lr_max_decays']
+
+	losses = []
+	status = 'finished'
+	_history[trial_id] = losses
+	for step in range(1, max_steps + 1):
+		train_step(train_x, train_y, model, optimizer, scheduler, step, max_decay_steps)
+
+		if step % eval_every == 0:
+			losses.append(validate(valid_x, valid_y, model))
+			# reassign, the proxy of a managed dict does not see in-place changes
+			_history[trial_id] = losses
+			print('trial %d, step %d, validation loss = %f' % (trial_id, step, losses[-1]), flush=True)
+			if step >= grace_steps and should_stop(trial_id, len(losses), losses[-1], min_peers):
+				status = 'stopped'
+				break
+
+	return {'trial': trial_id, 'status': status, 'steps': step,
+			'best_valid_loss': min(losses) if losses else float('nan'),
+			'last_valid_loss': losses[-1] if losses else float('nan'),
+			'minutes': (time.time() - start) / 60, 'config': config, 'error': ''}
+
+
+def print_results(results, out_file):
+	names = sorted(set(name for r in results for name in r['config']))
+	columns = ['trial', 'status', 'steps', 'best_valid_loss', 'last_valid_loss', 'minutes'] + names + ['error']
+	rows = [[r[c] for c in columns[:6]] + [r['config'].get(n, '') for n in names] + [r['error']] for r in results]
+	# trials without any validation loss (failed, or max_steps < eval_every) go last
+	rows.sort(key=lambda row: float('inf') if np.isnan(row[3]) else row[3])
+
+	fout = open(out_file, 'w')
+	fout.write('\t'.join(columns) + '\n')
+	for row in rows:
+		fout.write('\t'.join(str(v) for v in row) + '\n')
+	fout.close()
+
+	def fmt(v):
+		return '%.4f' % v if isinstance(v, float) else str(v)
+
+	widths = [max(len(c), max([len(fmt(row[i])) for row in rows] + [0])) for i, c in enumerate(columns)]
+	print('  '.join(c.ljust(w) for c, w in zip(columns, widths)))
+	for row in rows:
+		print('  '.join(fmt(v).ljust(w) for v, w in zip(row, widths)))
+	print('Results written to %s' % out_file)
+
+
+def main(args):
+	spec = json.load(open(args.spec))
+	configs = sample_configs(spec, args.n_trials, args.seed)
+	print('%d trials, %d at a time with %d threads each' % (len(configs), args.workers, args.threads))
+
+	data_dir = args.data_dir
+	TRAIN_X = os.path.join(data_dir, 'train/train.article.txt')
+	TRAIN_Y = os.path.join(data_dir, 'train/train.title.txt')
+	VALID_X = os.path.join(data_dir, 'train/valid.article.filter.txt')
+	VALID_Y = os.path.join(data_dir, 'train/valid.title.filter.txt')
+
+	vocab_file = os.path.join(data_dir, "vocab.json")
+	if not os.path.exists(vocab_file):
+		utils.build_vocab([TRAIN_X, TRAIN_Y], vocab_file, n_vocab=50000)
+	vocab = json.load(open(vocab_file))
+
+	# tokenize once, the trials read the same shared memory instead of each loading the corpus
+	max_src_len = args.max_src_len or None
+	datas = {
+		'train_x': PackedData(load_data(TRAIN_X, vocab, args.n_train, max_len=max_src_len)).share_memory_(),
+		'train_y': PackedData(load_data(TRAIN_Y, vocab, args.n_train)).share_memory_(),
+		'valid_x': PackedData(load_data(VALID_X, vocab, args.n_valid, max_len=max_src_len)).share_memory_(),
+		'valid_y': PackedData(load_data(VALID_Y, vocab, args.n_valid)).share_memory_(),
+	}
+
+	ctx = mp.get_context('spawn')
+	history = ctx.Manager().dict()
+	pool = ctx.Pool(args.workers, initializer=init_worker,
+					initargs=(datas, vocab, history, args.threads))
+	jobs = [pool.apply_async(run_trial, (i, config, args.max_steps, args.eval_every,
+										 args.grace_steps, args.min_peers, args.seed))
+			for i, config in enumerate(configs)]
+	results = []
+	try:
+		for i, job in enumerate(jobs):
+			try:
+				results.append(job.get())
+			except Exception as e:
+				# e.g. the result could not be sent back from the worker
+				results.append(failed_result(i, configs[i], e))
+	finally:
+		pool.close()
+		pool.join()
+		print_results(results, args.out)
+
+
+if __name__ == '__main__':
+	args = parser.parse_args()
+	print(args)
+	main(args)
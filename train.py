@@ -2,10 +2,12 @@ import os
 import json
 import utils
 import torch
+import torch.utils.checkpoint
+import torch.nn.functional as F
 import argparse
 import shutil
 from Model import Model
-from utils import BatchManager, load_data
+from utils import BatchManager, SoftTargetBatchManager, load_data
 from tensorboardX import SummaryWriter
 import logging
 
@@ -17,42 +19,118 @@ parser.add_argument('--n_train', type=int, default=300000,
 parser.add_argument('--n_valid', type=int, default=70753,
 					help='Number of validation data (up to 70753 in gigaword) [default: 189651])')
 parser.add_argument('--batch_size', type=int, default=2, help='Mini batch size [default: 32]')
-parser.add_argument('--ckpt_file', type=str, default='./ckpts/params_0.pkl')
+parser.add_argument('--ckpt_file', type=str, default='', help='Checkpoint to resume from, start from scratch if empty')
+parser.add_argument('--model_dir', type=str, default='./ckpts', help='Directory to save checkpoints in')
 parser.add_argument('--data_dir', type=str, default='sumdata/')
-args = parser.parse_args()
-
-
-logging.basicConfig(
-	level=logging.INFO,
-	format='%(asctime)s - %(levelname)s - %(message)s',
-	filename='log/train.log',
-	filemode='w'
-)
-
-# define a new Handler to log to console as well
-console = logging.StreamHandler()
-# optional, set the logging level
-console.setLevel(logging.INFO)
-# set a format which is the same for console use
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-# tell the handler to use this format
-console.setFormatter(formatter)
-# add the handler to the root logger
-logging.getLogger('').addHandler(console)
-
-
-model_dir = './ckpts'
-if not os.path.exists(model_dir):
-	os.mkdir(model_dir)
-
-
-def run_batch(valid_x, valid_y, model):
-	batch_x = valid_x.next_batch().cuda()
-	batch_y = valid_y.next_batch().cuda()
-	mask = batch_x.eq(model.vocab['<pad>']).unsqueeze(1).cuda()
+parser.add_argument('--emb_dim', type=int, default=256, help='Embedding size [default: 256]')
+parser.add_argument('--hid_dim', type=int, default=512, help='Hidden size [default: 512]')
+parser.add_argument('--attn', type=str, default='bahdanau', choices=['bahdanau', 'local'],
+					help='bahdanau/local [default: bahdanau]')
+parser.add_argument('--window', type=int, default=10,
+					help='Half width of the source window of local attention [default: 10]')
+parser.add_argument('--max_src_len', type=int, default=0,
+					help='Truncate source articles to this many words, 0 to keep them whole [default: 0]')
+parser.add_argument('--ckpt_steps', type=int, default=0,
+					help='Checkpoint activations over chunks of this many decoder steps, '
+						 'trading recomputation for memory on long inputs, 0 to disable [default: 0]')
+parser.add_argument('--train_y', type=str, default='',
+					help='Training targets, e.g. teacher outputs cached by distill.py [default: train/train.title.txt]')
+parser.add_argument('--soft_targets', type=str, default='',
+					help='Teacher top-k logits cached by distill.py, enables word-level distillation')
+parser.add_argument('--kd_alpha', type=float, default=0.5,
+					help='Weight of the soft target loss in word-level distillation [default: 0.5]')
+parser.add_argument('--kd_temp', type=float, default=1.0,
+					help='Softmax temperature of word-level distillation [default: 1.0]')
+parser.add_argument('--lr', type=float, default=0.001,
+					help='Initial learning rate, ignored when resuming from --ckpt_file [default: 0.001]')
+parser.add_argument('--lr_step', type=int, default=0,
+					help='StepLR step size in batches, 0 for one epoch [default: 0]')
+parser.add_argument('--lr_gamma', type=float, default=0.5, help='StepLR decay factor [default: 0.5]')
+parser.add_argument('--lr_max_decays', type=int, default=6,
+					help='Stop decaying the learning rate after this many steps of StepLR, 0 for no limit [default: 6]')
+
+
+def init_logging(log_file='log/train.log'):
+	logging.basicConfig(
+		level=logging.INFO,
+		format='%(asctime)s - %(levelname)s - %(message)s',
+		filename=log_file,
+		filemode='w'
+	)
+
+	# define a new Handler to log to console as well
+	console = logging.StreamHandler()
+	# optional, set the logging level
+	console.setLevel(logging.INFO)
+	# set a format which is the same for console use
+	formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+	# tell the handler to use this format
+	console.setFormatter(formatter)
+	# add the handler to the root logger
+	logging.getLogger('').addHandler(console)
+
+
+def soft_target_loss(model, logit, target, soft_idx, soft_logit, kd_temp=1.0):
+	"""
+	cross entropy between the student and the teacher distribution renormalized over its top-k words
+	:param soft_idx, soft_logit: teacher top-k word ids and logits, in shape [batch, k]
+	"""
+	log_probs = F.log_softmax(logit / kd_temp, dim=-1).gather(1, soft_idx)
+	teacher_probs = F.softmax(soft_logit / kd_temp, dim=-1)
+	keep = target.ne(model.vocab['<pad>']).float()
+	loss = -((teacher_probs * log_probs).sum(-1) * keep).sum() / keep.sum().clamp(min=1)
+	return loss * kd_temp ** 2
+
+
+def decode_steps(model, batch_y, start, end, outputs, hidden, mask, enc_proj=None,
+				 soft=None, kd_alpha=0.5, kd_temp=1.0):
+	"""
+	teacher-forced decoding of steps [start, end), return the summed loss and the last hidden state
+	:param enc_proj: model.project_enc(outputs), shared by all the steps
+	:param soft: (soft_idx, soft_logit) of the teacher, in shape [batch, seq_len - 1, k], mixed into
+		the loss with weight kd_alpha
+	"""
+	loss = 0
+	for i in range(start, end):
+		logit, hidden = model.decode(batch_y[:, i], outputs, hidden, mask, enc_proj)
+		step_loss = model.loss_layer(logit, batch_y[:, i+1])
+		if soft is not None:
+			kd_loss = soft_target_loss(model, logit, batch_y[:, i+1], soft[0][:, i], soft[1][:, i], kd_temp)
+			step_loss = (1 - kd_alpha) * step_loss + kd_alpha * kd_loss
+		loss += step_loss
+	return loss, hidden
+
+
+def run_batch(valid_x, valid_y, model, ckpt_steps=0, valid_soft=None, kd_alpha=0.5, kd_temp=1.0):
+	"""
+	:param ckpt_steps: if > 0 and gradients are being recorded, only the decoder hidden states
+		at the boundaries of every ckpt_steps steps are kept, the activations inside each chunk
+		are recomputed during backward
+	:param valid_soft: SoftTargetBatchManager aligned with valid_y, for word-level distillation
+	"""
+	device = next(model.parameters()).device
+	batch_x = valid_x.next_batch().to(device)
+	batch_y = valid_y.next_batch().to(device)
+	mask = batch_x.eq(model.vocab['<pad>']).unsqueeze(1)
+	soft = None
+	if valid_soft is not None:
+		soft = [t.to(device) for t in valid_soft.next_batch()]
 
 	outputs, hidden = model.encode(batch_x)
 	hidden = model.init_decoder_hidden(hidden)
+	enc_proj = model.project_enc(outputs)
+
+	n_steps = batch_y.shape[1] - 1
+	if ckpt_steps > 0 and torch.is_grad_enabled():
+		loss = 0
+		for start in range(0, n_steps, ckpt_steps):
+			end = min(start + ckpt_steps, n_steps)
+			chunk_loss, hidden = torch.utils.checkpoint.checkpoint(
+				lambda o, h, p, s=start, e=end: decode_steps(model, batch_y, s, e, o, h, mask, p, soft, kd_alpha, kd_temp),
+				outputs, hidden, enc_proj, use_reentrant=False)
+			loss += chunk_loss
+		loss /= batch_y.shape[1]
+		return loss
 
 	# logits = torch.zeros(batch_y.shape[0], 0, model.n_vocab).cuda()
 	# for i in range(batch_y.shape[1]-1):
@@ -60,15 +138,32 @@ def run_batch(valid_x, valid_y, model):
 	# 	logits = torch.cat([logits, logit.unsqueeze(1)], dim=1)
 	# loss = model.loss_layer(logits.view(-1, model.n_vocab),
 	# 						batch_y[:, 1:].contiguous().view(-1))
-	loss = 0
-	for i in range(batch_y.shape[1] - 1):
-		logit, hidden = model.decode(batch_y[:, i], outputs, hidden, mask)
-		loss += model.loss_layer(logit, batch_y[:, i+1])
+	loss, _ = decode_steps(model, batch_y, 0, n_steps, outputs, hidden, mask, enc_proj, soft, kd_alpha, kd_temp)
 	loss /= batch_y.shape[1]
 	return loss
 
 
-def train(train_x, train_y, valid_x, valid_y, model, optimizer, scheduler, epoch=0, epochs=10):
+def train_step(train_x, train_y, model, optimizer, scheduler, step, max_decay_steps=0, ckpt_steps=0,
+			   train_soft=None, kd_alpha=0.5, kd_temp=1.0):
+	"""
+	one optimization step on the next training batch, the StepLR scheduler is stepped every batch
+	:param step: number of batches trained so far, this one included
+	:param max_decay_steps: stop stepping the scheduler after this many batches, 0 for no limit
+	"""
+	optimizer.zero_grad()
+
+	loss = run_batch(train_x, train_y, model, ckpt_steps, train_soft, kd_alpha, kd_temp)
+	loss.backward()  # do not use retain_graph=True
+	torch.nn.utils.clip_grad_value_(model.parameters(), 5)
+
+	optimizer.step()
+	if max_decay_steps == 0 or step <= max_decay_steps:
+		scheduler.step()
+	return loss
+
+
+def train(train_x, train_y, valid_x, valid_y, model, optimizer, scheduler, epoch=0, epochs=10, ckpt_steps=0,
+		  train_soft=None, kd_alpha=0.5, kd_temp=1.0, model_dir='./ckpts', max_decay_steps=0):
 	logging.info("Start to train...")
 	n_batches = train_x.steps
 	for epoch in range(epoch, epochs):
@@ -79,28 +174,28 @@ def train(train_x, train_y, valid_x, valid_y, model, optimizer, scheduler, epoch
 			shutil.rmtree('runs/epoch%d' % epoch)
 		writer = SummaryWriter('runs/epoch%d' % epoch)
 		for idx in range(n_batches):
-			optimizer.zero_grad()
-
-			loss = run_batch(train_x, train_y, model)
-			loss.backward()  # do not use retain_graph=True
-			torch.nn.utils.clip_grad_value_(model.parameters(), 5)
-
-			optimizer.step()
+			loss = train_step(train_x, train_y, model, optimizer, scheduler, epoch * n_batches + idx + 1,
+							  max_decay_steps, ckpt_steps, train_soft, kd_alpha, kd_temp)
 
 			if (idx + 1) % 50 == 0:
 				train_loss = loss.cpu().detach().numpy()
+				# peak memory over the last 50 training batches, not per batch
+				peak_mem = torch.cuda.max_memory_allocated() / 2**20
 				model.eval()
 				with torch.no_grad():
 					valid_loss = run_batch(valid_x, valid_y, model)
-				logging.info('epoch %d, step %d, training loss = %f, validation loss = %f'
-							 % (epoch, idx + 1, train_loss, valid_loss))
+				logging.info('epoch %d, step %d, training loss = %f, validation loss = %f, '
+							 'peak memory over the last 50 batches = %.1f MB'
+							 % (epoch, idx + 1, train_loss, valid_loss, peak_mem))
 				model.train()
 				writer.add_scalar('train_loss', train_loss, (idx + 1) / 50)
 				writer.add_scalar('valid_loss', valid_loss, (idx + 1) / 50)
-		if epoch < 6:
-			scheduler.step()
+				writer.add_scalar('peak_mem_mb_last50', peak_mem, (idx + 1) / 50)
+				torch.cuda.reset_peak_memory_stats()
 		# writer.close()
 		saved_state = {'epoch': epoch + 1, 'lr': optimizer.param_groups[0]['lr'],
+					   'emb_dim': model.emb_dim, 'hid_dim': model.hid_dim,
+					   'attn': model.attn, 'window': getattr(model.attn_layer, 'window', None),
 					   'state_dict': model.state_dict()}
 		torch.save(saved_state, os.path.join(model_dir, 'params_%d.pkl' % epoch))
 		logging.info('Model saved in dir %s' % model_dir)
@@ -109,6 +204,10 @@ def train(train_x, train_y, valid_x, valid_y, model, optimizer, scheduler, epoch
 def main():
 	print(args)
 
+	model_dir = args.model_dir
+	if not os.path.exists(model_dir):
+		os.mkdir(model_dir)
+
 	N_EPOCHS = args.n_epochs
 	N_TRAIN = args.n_train
 	N_VALID = args.n_valid
@@ -127,35 +226,66 @@ def main():
 		utils.build_vocab([TRAIN_X, TRAIN_Y], vocab_file, n_vocab=50000)
 
 	vocab = json.load(open(vocab_file))
+	if args.train_y:
+		# e.g. sequence-level distillation, where the teacher outputs replace the reference titles
+		TRAIN_Y = args.train_y
 		
 	# embedding_path = 'kaggle_ckpt/SEASS/ckpts/params_0.pkl'
 	# vocab, embeddings = utils.load_word2vec_embedding(embedding_path)
 
 
-	train_x = BatchManager(load_data(TRAIN_X, vocab, N_TRAIN), BATCH_SIZE)
+	MAX_SRC_LEN = args.max_src_len or None
+	train_x = BatchManager(load_data(TRAIN_X, vocab, N_TRAIN, max_len=MAX_SRC_LEN), BATCH_SIZE)
 	train_y = BatchManager(load_data(TRAIN_Y, vocab, N_TRAIN), BATCH_SIZE)
-
-	valid_x = BatchManager(load_data(VALID_X, vocab, N_VALID), BATCH_SIZE)
+	if len(train_x.datas) != len(train_y.datas):
+		raise ValueError('%s holds %d samples but %s holds %d, articles and targets are paired by line'
+						 % (TRAIN_X, len(train_x.datas), TRAIN_Y, len(train_y.datas)))
+
+	train_soft = None
+	if args.soft_targets:
+		soft_targets = torch.load(args.soft_targets)
+		# the cache is matched to the training targets by index, so both must be the same data
+		if soft_targets['targets'] != os.path.abspath(TRAIN_Y):
+			raise ValueError('soft targets in %s were computed on %s, but the training targets are %s, '
+							 'pass the same file with --train_y'
+							 % (args.soft_targets, soft_targets['targets'], TRAIN_Y))
+		if soft_targets['targets_stamp'] != utils.file_stamp(TRAIN_Y):
+			raise ValueError('%s has changed since the soft targets in %s were computed (teacher %s), '
+							 'rerun distill.py to refresh them'
+							 % (TRAIN_Y, args.soft_targets, soft_targets['teacher_ckpt']))
+		if len(soft_targets['offsets']) - 1 != len(train_y.datas):
+			raise ValueError('soft targets in %s hold %d samples, but there are %d training samples, '
+							 'use the same --n_train in distill.py and train.py'
+							 % (args.soft_targets, len(soft_targets['offsets']) - 1, len(train_y.datas)))
+		train_soft = SoftTargetBatchManager(soft_targets, BATCH_SIZE)
+		logging.info('Load teacher soft targets of %s from %s' % (soft_targets['teacher_ckpt'], args.soft_targets))
+
+	valid_x = BatchManager(load_data(VALID_X, vocab, N_VALID, max_len=MAX_SRC_LEN), BATCH_SIZE)
 	valid_y = BatchManager(load_data(VALID_Y, vocab, N_VALID), BATCH_SIZE)
 
 
-	model = Model(vocab, emb_dim=256, hid_dim=512, embeddings=None).cuda()
+	model = Model(vocab, emb_dim=args.emb_dim, hid_dim=args.hid_dim, embeddings=None,
+				  attn=args.attn, window=args.window).cuda()
 	# model.embedding_look_up.to(torch.device("cpu"))
 
 	ckpt_file = args.ckpt_file
-	saved_state = {'lr': 0.001, 'epoch': 0}
-	if os.path.exists(ckpt_file):
+	saved_state = {'lr': args.lr, 'epoch': 0}
+	if ckpt_file:
 		saved_state = torch.load(ckpt_file)
 		model.load_state_dict(saved_state['state_dict'])
 		logging.info('Load model parameters from %s' % ckpt_file)
 
 	optimizer = torch.optim.Adam(model.parameters(), lr=saved_state['lr'])
-	scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=1, gamma=0.5)
-	# scheduler.step()
+	# by default the learning rate is halved after each of the first 6 epochs
+	lr_step = args.lr_step or train_x.steps
+	scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=lr_step, gamma=args.lr_gamma)
 
 	train(train_x, train_y, valid_x, valid_y, model, optimizer,
-		  scheduler, saved_state['epoch'], N_EPOCHS)
+		  scheduler, saved_state['epoch'], N_EPOCHS, args.ckpt_steps, train_soft, args.kd_alpha, args.kd_temp,
+		  model_dir, lr_step * args.lr_max_decays)
 
 
 if __name__ == '__main__':
-	main()
\ No newline at end of file
+	args = parser.parse_args()
+	init_logging()
+	main()
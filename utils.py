@@ -1,3 +1,4 @@
+import os
 import json
 import numpy as np
 from collections import defaultdict
@@ -6,6 +7,7 @@ from torch.utils.data import Dataset, DataLoader
 from torch.nn.utils.rnn import pad_sequence
 import torch
 import threading
+import itertools
 
 
 start_tok = "<s>"
@@ -46,6 +48,73 @@ class BatchManager:
         return batch
 
 
+class PackedData:
+    """
+    token id lists packed into two flat tensors, a drop-in for the list of lists given to
+    BatchManager; after share_memory_() several processes can read it without each holding a copy
+    """
+    def __init__(self, datas):
+        lengths = [len(d) for d in datas]
+        self.offsets = torch.from_numpy(np.cumsum([0] + lengths))
+        self.tokens = torch.from_numpy(np.fromiter(itertools.chain.from_iterable(datas),
+                                                   dtype=np.int32, count=sum(lengths)))
+
+    def share_memory_(self):
+        self.offsets.share_memory_()
+        self.tokens.share_memory_()
+        return self
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        return self.tokens[self.offsets[idx]: self.offsets[idx + 1]].tolist()
+
+
+class SoftTargetBatchManager(BatchManager):
+    """
+    batches of the teacher outputs cached by distill.py, packed like PackedData: the top-k word ids
+    and logits of all samples are concatenated into [n_steps_total, k] tensors, sample i spanning
+    rows offsets[i]: offsets[i+1], and each batch is padded with zeros to its longest sample
+    """
+    def __init__(self, soft_targets, batch_size):
+        self.offsets = soft_targets['offsets']
+        self.idx = soft_targets['idx']
+        self.logits = soft_targets['logits']
+        super(SoftTargetBatchManager, self).__init__(range(len(self.offsets) - 1), batch_size)
+
+    def next_batch(self):
+        samples = self.datas[self.bid * self.batch_size: (self.bid + 1) * self.batch_size]
+        starts, ends = self.offsets[samples.start: samples.stop], self.offsets[samples.start + 1: samples.stop + 1]
+        max_len = int((ends - starts).max())
+        k = self.idx.shape[1]
+        soft_idx = torch.zeros(len(samples), max_len, k, dtype=torch.long)
+        soft_logit = torch.zeros(len(samples), max_len, k)
+        for i, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+            soft_idx[i, :end - start] = self.idx[start: end]
+            soft_logit[i, :end - start] = self.logits[start: end]
+        self.bid += 1
+        if self.bid == self.steps:
+            self.bid = 0
+        return soft_idx, soft_logit
+
+
+def file_stamp(filename):
+    """
+    size and modification time of a file, recorded with a cache built from it, to tell
+    when the file has been rewritten since
+    """
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def count_lines(filename):
+    with open(filename, "r", encoding="utf8") as fin:
+        return sum(1 for _ in fin)
+
+
 def build_vocab(filelist=['sumdata/train/train.article.txt', 'sumdata/train/train.title.txt'],
                 vocab_file='sumdata/vocab.json', min_count=0, n_vocab=130000):
     print("Building vocab with min_count=%d..." % min_count)
@@ -110,15 +179,61 @@ def build_vocab_from_embeddings(embedding_path, data_file_list):
     return vocab
 
 
-def load_data(filename, vocab, n_data=None, target=False):
+def load_data(filename, vocab, n_data=None, target=False, max_len=None):
+    """
+    :param max_len: if given, keep only the first max_len words of each line
+        (before <s> and </s> are added), used to bound source length of long documents
+    """
     fin = open(filename, "r", encoding="utf8")
     datas = []
     for idx, line in enumerate(fin):
         if idx == n_data or line == '':
             break
         words = line.strip().split()
+        if max_len:
+            words = words[:max_len]
         # if target:
         words = ['<s>'] + words + ['</s>']
         sample = [vocab[w if w in vocab else unk_tok] for w in words]
         datas.append(sample)
     return datas
+
+
+def _ngrams(words, n):
+    counts = defaultdict(int)
+    for i in range(len(words) - n + 1):
+        counts[tuple(words[i:i+n])] += 1
+    return counts
+
+
+def rouge_n(hyp, ref, n=1):
+    """
+    F1 of ROUGE-N between two token lists, a quick approximation of the official
+    ROUGE script (no stemming, no stopword removal)
+    """
+    hyp_ngrams, ref_ngrams = _ngrams(hyp, n), _ngrams(ref, n)
+    overlap = sum(min(c, ref_ngrams[g]) for g, c in hyp_ngrams.items() if g in ref_ngrams)
+    n_hyp, n_ref = sum(hyp_ngrams.values()), sum(ref_ngrams.values())
+    if overlap == 0:
+        return 0.0
+    p, r = overlap / n_hyp, overlap / n_ref
+    return 2 * p * r / (p + r)
+
+
+def rouge_l(hyp, ref):
+    """
+    F1 of ROUGE-L between two token lists, based on their longest common subsequence
+    """
+    if len(hyp) == 0 or len(ref) == 0:
+        return 0.0
+    lcs = [[0] * (len(ref) + 1) for _ in range(len(hyp) + 1)]
+    for i in range(len(hyp)):
+        for j in range(len(ref)):
+            if hyp[i] == ref[j]:
+                lcs[i+1][j+1] = lcs[i][j] + 1
+            else:
+                lcs[i+1][j+1] = max(lcs[i][j+1], lcs[i+1][j])
+    if lcs[-1][-1] == 0:
+        return 0.0
+    p, r = lcs[-1][-1] / len(hyp), lcs[-1][-1] / len(ref)
+    return 2 * p * r / (p + r)